@@ -1,18 +1,61 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 import uuid
 
 DB_PATH = Path(__file__).parent / "chat_history.db"
 
+# Applied once when each thread's connection is opened
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Prepared statements kept per connection; the module's queries are constant
+# strings, so each is parsed once per thread
+STATEMENT_CACHE_SIZE = 256
+
+INSERT_MESSAGE = "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)"
+
+_local = threading.local()
+
 
 def get_connection():
-    """Get database connection."""
-    conn = sqlite3.connect(str(DB_PATH))
-    conn.row_factory = sqlite3.Row
+    """Get the persistent database connection for the current thread."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            str(DB_PATH),
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
     return conn
 
 
+@contextmanager
+def transaction():
+    """Run several statements as one write transaction on the shared connection."""
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
 def init_db():
     """Initialize database tables."""
     conn = get_connection()
@@ -37,21 +80,23 @@ def init_db():
         )
     """)
     
-    conn.commit()
-    conn.close()
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_sid_ts ON messages (session_id, timestamp)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions (created_at DESC)"
+    )
 
 
-def create_session(title: str = "New Chat") -> str:
-    """Create a new chat session."""
+def create_session(title: str = "New Chat") -> dict:
+    """Create a new chat session and return the created row."""
     conn = get_connection()
     session_id = str(uuid.uuid4())
-    conn.execute(
-        "INSERT INTO sessions (id, title) VALUES (?, ?)",
+    cursor = conn.execute(
+        "INSERT INTO sessions (id, title) VALUES (?, ?) RETURNING id, title, created_at",
         (session_id, title)
     )
-    conn.commit()
-    conn.close()
-    return session_id
+    return dict(cursor.fetchone())
 
 
 def get_all_sessions():
@@ -61,19 +106,39 @@ def get_all_sessions():
         "SELECT id, title, created_at FROM sessions ORDER BY created_at DESC"
     )
     sessions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return sessions
 
 
-def get_session_messages(session_id: str):
-    """Get all messages for a session."""
+def get_session_messages_raw(session_id: str):
+    """Get all messages for a session as (id, role, content, timestamp) tuples."""
+    cursor = get_connection().cursor()
+    cursor.row_factory = None
+    cursor.execute(
+        "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? ORDER BY timestamp ASC, id ASC",
+        (session_id,)
+    )
+    return cursor.fetchall()
+
+
+def session_exists(session_id: str) -> bool:
+    """Check whether a session row exists."""
     conn = get_connection()
     cursor = conn.execute(
-        "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? ORDER BY timestamp ASC",
+        "SELECT EXISTS(SELECT 1 FROM sessions WHERE id = ?)",
         (session_id,)
     )
+    return bool(cursor.fetchone()[0])
+
+
+def get_recent_messages(session_id: str, limit: int = 6):
+    """Get the most recent messages for a session, oldest first."""
+    conn = get_connection()
+    cursor = conn.execute(
+        "SELECT role, content FROM messages WHERE session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (session_id, limit)
+    )
     messages = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    messages.reverse()
     return messages
 
 
@@ -81,11 +146,29 @@ def add_message(session_id: str, role: str, content: str):
     """Add a message to a session."""
     conn = get_connection()
     conn.execute(
-        "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+        INSERT_MESSAGE,
         (session_id, role, content)
     )
-    conn.commit()
-    conn.close()
+
+
+def add_messages(rows: list):
+    """Add several (session_id, role, content) messages in one transaction."""
+    with transaction() as conn:
+        conn.executemany(INSERT_MESSAGE, rows)
+
+
+def record_turn(session_id: str, user_msg: str, assistant_msg: str, title: str = None):
+    """Save a user/assistant exchange (and optional new title) in one transaction."""
+    with transaction() as conn:
+        conn.executemany(
+            INSERT_MESSAGE,
+            [(session_id, "user", user_msg), (session_id, "assistant", assistant_msg)]
+        )
+        if title is not None:
+            conn.execute(
+                "UPDATE sessions SET title = ? WHERE id = ?",
+                (title, session_id)
+            )
 
 
 def update_session_title(session_id: str, title: str):
@@ -95,17 +178,12 @@ def update_session_title(session_id: str, title: str):
         "UPDATE sessions SET title = ? WHERE id = ?",
         (title, session_id)
     )
-    conn.commit()
-    conn.close()
 
 
 def delete_session(session_id: str):
-    """Delete a session and its messages."""
+    """Delete a session; its messages are removed by ON DELETE CASCADE."""
     conn = get_connection()
-    conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
     conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-    conn.commit()
-    conn.close()
 
 
 # Initialize database on import
@@ -1,11 +1,22 @@
+import json
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
 import database
 import rag
 
-app = FastAPI(title="Government Schemes Chatbot API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the embedding model and scheme index once at server start."""
+    rag.init()
+    yield
+
+
+app = FastAPI(title="Government Schemes Chatbot API", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -44,6 +55,18 @@ class MessageResponse(BaseModel):
     timestamp: str
 
 
+def _resolve_session(session_id: Optional[str]) -> str:
+    """Return the session to chat in, creating one if none was given."""
+    # Create new session if not provided
+    if not session_id:
+        return database.create_session()["id"]
+    # Messages reference sessions by foreign key, so reject unknown (e.g.
+    # deleted) sessions before spending a Gemini call on them
+    if not database.session_exists(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session_id
+
+
 @app.get("/")
 async def root():
     return {"message": "Government Schemes Chatbot API", "status": "running"}
@@ -52,43 +75,72 @@ async def root():
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Send a message and get a response."""
-    session_id = request.session_id
-    
-    # Create new session if not provided
-    if not session_id:
-        session_id = database.create_session()
-    
-    # Get chat history for context
-    history = database.get_session_messages(session_id)
-    chat_history = [{"role": msg["role"], "content": msg["content"]} for msg in history]
+    session_id = _resolve_session(request.session_id)
     
-    # Save user message
-    database.add_message(session_id, "user", request.query)
+    # Get recent chat history for context
+    chat_history = database.get_recent_messages(session_id, limit=6)
     
-    # Generate response using RAG
-    response = rag.generate_response(request.query, chat_history)
-    
-    # Save assistant response
-    database.add_message(session_id, "assistant", response)
+    # Generate response using RAG in a worker thread so the embedding and
+    # Gemini calls don't block the event loop for other requests
+    response = await run_in_threadpool(rag.generate_response, request.query, chat_history)
     
     # Update session title based on first message
-    if len(history) == 0:
+    title = None
+    if not chat_history:
         # Use first few words of query as title
         title = request.query[:50] + "..." if len(request.query) > 50 else request.query
-        database.update_session_title(session_id, title)
+    
+    # Save both messages (and the new title) in a single transaction
+    database.record_turn(session_id, request.query, response, title=title)
     
     return ChatResponse(response=response, session_id=session_id)
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Send a message and stream the response as server-sent events."""
+    session_id = _resolve_session(request.session_id)
+    
+    # Get recent chat history for context
+    chat_history = database.get_recent_messages(session_id, limit=6)
+    
+    # Use first few words of query as title for a new conversation
+    title = None
+    if not chat_history:
+        title = request.query[:50] + "..." if len(request.query) > 50 else request.query
+    
+    def event_stream():
+        # If the client disconnects mid-stream this generator is closed at the
+        # pending yield, so an incomplete turn is never saved
+        yield f"data: {json.dumps({'session_id': session_id})}\n\n"
+        
+        response_parts = []
+        try:
+            for text in rag.stream_response(request.query, chat_history):
+                response_parts.append(text)
+                yield f"data: {json.dumps({'text': text})}\n\n"
+        except Exception as e:
+            # Don't save a partial answer; it would be replayed as model history
+            yield f"data: {json.dumps({'error': rag.error_message(e)})}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        
+        # Save the turn only once the full response has been generated, and
+        # report a failed save to the client instead of cutting the stream
+        try:
+            database.record_turn(session_id, request.query, "".join(response_parts), title=title)
+        except Exception as e:
+            yield f"data: {json.dumps({'error': f'Failed to save this message: {str(e)}'})}\n\n"
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.post("/api/session", response_model=SessionResponse)
 async def create_session(request: SessionCreate):
     """Create a new chat session."""
-    session_id = database.create_session(request.title)
-    sessions = database.get_all_sessions()
-    session = next((s for s in sessions if s["id"] == session_id), None)
-    if session:
-        return SessionResponse(**session)
-    raise HTTPException(status_code=500, detail="Failed to create session")
+    session = database.create_session(request.title)
+    return SessionResponse(**session)
 
 
 @app.get("/api/sessions", response_model=List[SessionResponse])
@@ -101,8 +153,11 @@ async def get_sessions():
 @app.get("/api/session/{session_id}/messages", response_model=List[MessageResponse])
 async def get_session_messages(session_id: str):
     """Get all messages for a session."""
-    messages = database.get_session_messages(session_id)
-    return [MessageResponse(**m) for m in messages]
+    # Rows come straight from our own database, so skip re-validating them
+    return [
+        MessageResponse.model_construct(id=r[0], role=r[1], content=r[2], timestamp=r[3])
+        for r in database.get_session_messages_raw(session_id)
+    ]
 
 
 @app.delete("/api/session/{session_id}")
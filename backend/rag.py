@@ -1,26 +1,60 @@
-import json
 import os
+from contextlib import contextmanager
+from functools import lru_cache
+import orjson
 from pathlib import Path
 from dotenv import load_dotenv
 import chromadb
+import torch
 from chromadb import Documents, EmbeddingFunction, Embeddings
 from sentence_transformers import SentenceTransformer
 import google.generativeai as genai
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 load_dotenv()
 
 # Configure Gemini
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+SYSTEM_PROMPT = """You are a helpful assistant specializing in Indian government schemes, particularly for Tamil Nadu and all-India schemes. 
+Your role is to provide accurate, detailed information about government schemes based ONLY on the context provided with each question.
+
+CRITICAL RULES:
+1. ONLY use information from the provided context - DO NOT make up or add information
+2. If the answer is not in the context, clearly state "I don't have information about this in the provided schemes database"
+3. Be specific and cite exact scheme names from the context
+4. When providing details, copy them accurately from the context (eligibility, benefits, application process)
+5. Format your response in clear, well-structured markdown with tables where appropriate
+6. If multiple relevant schemes are found, compare them to help the user choose
+7. MAINTAIN CONVERSATION CONTEXT: If the user asks a follow-up question (like "where do I apply?" or "what documents needed?"), answer about the SAME schemes discussed in the previous messages, NOT about different schemes
+"""
+
+# Gemini model with the rules set once as its system instruction. Explicit
+# context caching (CachedContent) is not used: the prompt is far below the
+# API's minimum cacheable size and caching needs a pinned model version, while
+# a repeated system instruction prefix is already eligible for Gemini's
+# implicit caching.
+llm = genai.GenerativeModel('models/gemini-flash-latest', system_instruction=SYSTEM_PROMPT)
+
 # Paths
 CHROMA_PATH = Path(__file__).parent / "chroma_db"
-SCHEMES_PATH = Path(__file__).parent / os.getenv("SCHEMES_JSON_PATH", "../../cleanedTamilNadu_statecentral_816scheme.json")
 
-# Initialize embedding model
-print("Loading embedding model...")
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-print("Embedding model loaded!")
+# HNSW parameters are fixed when the collection is created, so bump the name
+# when changing them to force a re-index
+COLLECTION_NAME = "government_schemes_v2"
+
+# Written once the collection has been fully indexed
+INDEXED_FLAG = CHROMA_PATH / f".{COLLECTION_NAME}.indexed"
 
+# Optional shared Chroma server (`chroma run --path ./chroma_db --port 8001`);
+# lets several uvicorn workers use one HNSW index instead of one copy each
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8001"))
+SCHEMES_PATH = Path(__file__).parent / os.getenv("SCHEMES_JSON_PATH", "../../cleanedTamilNadu_statecentral_816scheme.json")
 
 class SentenceTransformerEmbedding(EmbeddingFunction):
     """Custom embedding function for ChromaDB using SentenceTransformers."""
@@ -29,137 +63,213 @@ class SentenceTransformerEmbedding(EmbeddingFunction):
         self._model = model
     
     def __call__(self, input: Documents) -> Embeddings:
-        embeddings = self._model.encode(input, convert_to_numpy=True)
+        embeddings = self._model.encode(input, convert_to_numpy=True, normalize_embeddings=True)
         return embeddings.tolist()
     
     def name(self) -> str:
         return "sentence-transformer-all-MiniLM-L6-v2"
 
 
-# Initialize ChromaDB with persistent storage
-chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+# Set up by init() so importing this module stays cheap
+embedding_model = None
+chroma_client = None
+collection = None
+
+
+def init():
+    """Load the embedding model, open ChromaDB and index schemes if needed."""
+    global embedding_model, chroma_client, collection
+    if collection is not None:
+        return
+    
+    # Initialize embedding model (half precision when a GPU is available)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Loading embedding model on {device}...")
+    embedding_model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+    if device == "cuda":
+        embedding_model = embedding_model.half()
+    print("Embedding model loaded!")
+    
+    # Connect to the shared Chroma server if configured, otherwise open the
+    # persistent storage in-process
+    if CHROMA_HOST:
+        chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    else:
+        chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+    
+    # Create custom embedding function
+    embed_fn = SentenceTransformerEmbedding(embedding_model)
+    
+    # Get or create collection
+    collection = chroma_client.get_or_create_collection(
+        name=COLLECTION_NAME,
+        metadata={
+            "hnsw:space": "cosine",
+            "hnsw:M": 24,
+            "hnsw:construction_ef": 128,
+            "hnsw:search_ef": 100
+        },
+        embedding_function=embed_fn
+    )
+    
+    load_and_index_schemes()
+
+
+def _join(value, sep: str = "; ") -> str:
+    """Render a scheme field that may be either a list or a scalar."""
+    return sep.join(map(str, value)) if isinstance(value, list) else str(value)
+
 
-# Create custom embedding function
-embed_fn = SentenceTransformerEmbedding(embedding_model)
+def _format_application_process(app_process) -> str:
+    """Render the application process, which may be a Mode/Steps dict."""
+    if isinstance(app_process, dict):
+        mode = app_process.get("Mode", "")
+        steps = _join(app_process.get("Steps", []), " ")
+        return f"Mode - {mode}. Steps: {steps}"
+    return str(app_process)
 
-# Get or create collection
-collection = chroma_client.get_or_create_collection(
-    name="government_schemes",
-    metadata={"hnsw:space": "cosine"},
-    embedding_function=embed_fn
+
+# Optional scheme fields appended to each document, in order
+SCHEME_FIELDS = (
+    ("Details", str),
+    ("Benefits", _join),
+    ("Eligibility", _join),
+    ("Application Process", _format_application_process),
+    ("Documents Required", _join),
 )
 
 
+def _format_scheme(scheme: dict) -> str:
+    """Build the text document indexed for a single scheme."""
+    doc_parts = [
+        f"Scheme Name: {scheme.get('Scheme Name', 'Unknown Scheme')}",
+        f"Department: {scheme.get('Department', 'Unknown Department')}",
+    ]
+    for field, formatter in SCHEME_FIELDS:
+        value = scheme.get(field)
+        if value:
+            doc_parts.append(f"{field}: {formatter(value)}")
+    return "\n".join(doc_parts)
+
+
+@contextmanager
+def _index_lock():
+    """Hold an exclusive lock so only one process on this host indexes at a time."""
+    CHROMA_PATH.mkdir(exist_ok=True)
+    with open(CHROMA_PATH / ".index.lock", "w") as lock_file:
+        # fcntl is unavailable on Windows; run a single worker there
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
 def load_and_index_schemes():
     """Load schemes from JSON and index them in ChromaDB."""
-    # Check if already indexed
-    if collection.count() > 0:
-        print(f"Schemes already indexed. Found {collection.count()} documents.")
+    # Check if already indexed, skipping the count when a previous run
+    # finished indexing. The local flag says nothing about a remote server.
+    use_flag = not CHROMA_HOST
+    if use_flag and INDEXED_FLAG.exists():
+        print("Schemes already indexed.")
         return
     
-    print("Loading and indexing schemes...")
+    # Workers starting together wait here while one of them indexes, then
+    # find the collection populated
+    with _index_lock():
+        _index_schemes(use_flag)
+
+
+def _index_schemes(use_flag: bool):
+    """Index schemes into an empty collection (call with the index lock held)."""
+    count = collection.count()
+    if count > 0:
+        print(f"Schemes already indexed. Found {count} documents.")
+        if use_flag:
+            INDEXED_FLAG.touch()
+        return
     
-    with open(SCHEMES_PATH, 'r', encoding='utf-8') as f:
-        schemes = json.load(f)
+    print("Loading and indexing schemes...")
     
-    documents = []
-    metadatas = []
-    ids = []
+    schemes = orjson.loads(SCHEMES_PATH.read_bytes())
     
-    for i, scheme in enumerate(schemes):
-        # Create a comprehensive text document for each scheme
-        doc_parts = []
-        
-        scheme_name = scheme.get("Scheme Name", "Unknown Scheme")
-        department = scheme.get("Department", "Unknown Department")
-        
-        doc_parts.append(f"Scheme Name: {scheme_name}")
-        doc_parts.append(f"Department: {department}")
-        
-        if scheme.get("Details"):
-            doc_parts.append(f"Details: {scheme['Details']}")
-        
-        if scheme.get("Benefits"):
-            benefits = scheme["Benefits"]
-            if isinstance(benefits, list):
-                doc_parts.append(f"Benefits: {'; '.join(str(b) for b in benefits)}")
-            else:
-                doc_parts.append(f"Benefits: {benefits}")
-        
-        if scheme.get("Eligibility"):
-            eligibility = scheme["Eligibility"]
-            if isinstance(eligibility, list):
-                doc_parts.append(f"Eligibility: {'; '.join(str(e) for e in eligibility)}")
-            else:
-                doc_parts.append(f"Eligibility: {eligibility}")
-        
-        if scheme.get("Application Process"):
-            app_process = scheme["Application Process"]
-            if isinstance(app_process, dict):
-                mode = app_process.get("Mode", "")
-                steps = app_process.get("Steps", [])
-                if isinstance(steps, list):
-                    steps_text = " ".join(str(s) for s in steps)
-                else:
-                    steps_text = str(steps)
-                doc_parts.append(f"Application Process: Mode - {mode}. Steps: {steps_text}")
-            else:
-                doc_parts.append(f"Application Process: {app_process}")
-        
-        if scheme.get("Documents Required"):
-            docs_req = scheme["Documents Required"]
-            if isinstance(docs_req, list):
-                doc_parts.append(f"Documents Required: {'; '.join(str(d) for d in docs_req)}")
-            else:
-                doc_parts.append(f"Documents Required: {docs_req}")
-        
-        full_doc = "\n".join(doc_parts)
-        
-        documents.append(full_doc)
-        metadatas.append({
-            "scheme_name": scheme_name,
-            "department": department,
+    documents = [_format_scheme(scheme) for scheme in schemes]
+    metadatas = [
+        {
+            "scheme_name": scheme.get("Scheme Name", "Unknown Scheme"),
+            "department": scheme.get("Department", "Unknown Department"),
             "index": i
-        })
-        ids.append(f"scheme_{i}")
+        }
+        for i, scheme in enumerate(schemes)
+    ]
+    ids = [f"scheme_{i}" for i in range(len(schemes))]
+    
+    # Embed all documents up front so the model runs in large batches
+    embeddings = embedding_model.encode(
+        documents,
+        batch_size=256,
+        show_progress_bar=True,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
     
     # Add to collection in batches
-    batch_size = 50
+    batch_size = 200
     for i in range(0, len(documents), batch_size):
         end_idx = min(i + batch_size, len(documents))
         collection.add(
             documents=documents[i:end_idx],
+            embeddings=embeddings[i:end_idx].tolist(),
             metadatas=metadatas[i:end_idx],
             ids=ids[i:end_idx]
         )
         print(f"Indexed {end_idx}/{len(documents)} schemes...")
     
+    if use_flag:
+        INDEXED_FLAG.touch()
     print(f"Successfully indexed {len(documents)} schemes!")
 
 
-def search_schemes(query: str, n_results: int = 5):
-    """Search for relevant schemes based on query."""
-    results = collection.query(
-        query_texts=[query],
+def _normalize_query(query: str) -> str:
+    """Normalize a query for cache lookups (the MiniLM tokenizer is uncased)."""
+    return " ".join(query.lower().split())
+
+
+@lru_cache(maxsize=1024)
+def _embed(text: str) -> tuple:
+    """Embed a normalized query; cached so repeated queries skip the model."""
+    return tuple(embedding_model.encode([text], normalize_embeddings=True)[0].tolist())
+
+
+@lru_cache(maxsize=1024)
+def _search(query: str, n_results: int):
+    return collection.query(
+        query_embeddings=[list(_embed(query))],
         n_results=n_results
     )
-    return results
 
 
-def generate_response(query: str, chat_history: list = None):
-    """Generate a response using RAG with Gemini."""
+def search_schemes(query: str, n_results: int = 5):
+    """Search for relevant schemes based on query."""
+    return _search(_normalize_query(query), n_results)
+
+
+# Characters of each earlier user message folded into the search query
+MAX_QUERY_CONTEXT_CHARS = 200
+
+
+def _build_prompt(query: str, chat_history: list = None):
+    """Retrieve context for a query and build the Gemini history and prompt."""
     
-    # Build search query with context from chat history
-    search_query = query
-    if chat_history and len(chat_history) > 0:
-        # Include last 2 user messages for context
-        recent_user_queries = [msg["content"] for msg in chat_history[-4:] if msg["role"] == "user"]
-        if recent_user_queries:
-            # Combine recent queries with current query for better search
-            search_query = " ".join(recent_user_queries[-2:]) + " " + query
+    # Build search query with context from chat history: combine the last 2
+    # user messages (truncated) with the current query for better search
+    recent_user_queries = [
+        msg["content"][:MAX_QUERY_CONTEXT_CHARS]
+        for msg in (chat_history or [])[-4:]
+        if msg["role"] == "user"
+    ][-2:]
+    search_query = " ".join(recent_user_queries + [query])
     
-    # Search for more schemes to ensure we get relevant ones
-    search_results = search_schemes(search_query, n_results=10)
+    # Search for the top schemes; distances below filter what is kept
+    search_results = search_schemes(search_query, n_results=5)
 
     
     # Build context from search results with relevance filtering
@@ -169,11 +279,12 @@ def generate_response(query: str, chat_history: list = None):
         distances = search_results['distances'][0]
         
         # Only include results with good relevance (low distance)
-        # Lower distance = more relevant
+        # Lower distance = more relevant; results come back sorted by distance
         for i, (doc, distance) in enumerate(zip(documents, distances)):
-            # Only include if distance is reasonable (< 1.5 is usually good)
-            if distance < 1.5:
-                context_parts.append(f"--- Relevant Scheme {i+1} (Relevance: {1.0 - distance:.2f}) ---\n{doc}")
+            # Stop at the first result that is too far (< 1.5 is usually good)
+            if distance >= 1.5:
+                break
+            context_parts.append(f"--- Relevant Scheme {i+1} (Relevance: {1.0 - distance:.2f}) ---\n{doc}")
     
     # If no relevant results, inform the AI
     if not context_parts:
@@ -182,28 +293,9 @@ def generate_response(query: str, chat_history: list = None):
         context = "\n\n".join(context_parts)
     
     
-    # Build the prompt
-    system_prompt = """You are a helpful assistant specializing in Indian government schemes, particularly for Tamil Nadu and all-India schemes. 
-Your role is to provide accurate, detailed information about government schemes based ONLY on the context provided below.
-
-CRITICAL RULES:
-1. ONLY use information from the context provided below - DO NOT make up or add information
-2. If the answer is not in the context, clearly state "I don't have information about this in the provided schemes database"
-3. Be specific and cite exact scheme names from the context
-4. When providing details, copy them accurately from the context (eligibility, benefits, application process)
-5. Format your response in clear, well-structured markdown with tables where appropriate
-6. If multiple relevant schemes are found, compare them to help the user choose
-7. MAINTAIN CONVERSATION CONTEXT: If the user asks a follow-up question (like "where do I apply?" or "what documents needed?"), answer about the SAME schemes discussed in the previous messages, NOT about different schemes
-
-Context from relevant government schemes:
-"""
-
-    # Add conversation context note if there's chat history
-    context_note = ""
-    if chat_history and len(chat_history) > 0:
-        context_note = "\n\nNOTE: This is a follow-up question in an ongoing conversation. Make sure to answer about the schemes already being discussed, not new unrelated schemes."
-    
-    full_prompt = f"{system_prompt}\n\n{context}\n\n---\n\nUser Question: {query}{context_note}\n\nPlease answer based ONLY on the schemes provided in the context above."
+    # Send the retrieved context with the question; the rules live in the
+    # model's system instruction
+    prompt = f"Context:\n{context}\n\nQuestion: {query}"
     
     # Build conversation history for Gemini
     messages = []
@@ -213,23 +305,34 @@ Context from relevant government schemes:
             role = "user" if msg["role"] == "user" else "model"
             messages.append({"role": role, "parts": [msg["content"]]})
     
-    # Add current query with context
-    messages.append({"role": "user", "parts": [full_prompt]})
-    
-    # Generate response using Gemini
-    model = genai.GenerativeModel('models/gemini-flash-latest')
-    
+    return messages, prompt
+
+
+def _send(query: str, chat_history: list = None, stream: bool = False):
+    """Send the RAG prompt to Gemini and return its (possibly streaming) response."""
+    history, prompt = _build_prompt(query, chat_history)
+    chat = llm.start_chat(history=history)
+    return chat.send_message(prompt, stream=stream)
+
+
+def error_message(e: Exception) -> str:
+    """Apology shown to the user when generating a response fails."""
+    return f"I apologize, but I encountered an error while processing your request: {str(e)}"
+
+
+def generate_response(query: str, chat_history: list = None):
+    """Generate a response using RAG with Gemini."""
     try:
-        if len(messages) == 1:
-            response = model.generate_content(full_prompt)
-        else:
-            chat = model.start_chat(history=messages[:-1])
-            response = chat.send_message(full_prompt)
-        
-        return response.text
+        return _send(query, chat_history).text
     except Exception as e:
-        return f"I apologize, but I encountered an error while processing your request: {str(e)}"
+        return error_message(e)
 
 
-# Index schemes on module load
-load_and_index_schemes()
+def stream_response(query: str, chat_history: list = None):
+    """Generate a response using RAG with Gemini, yielding text as it arrives.
+    
+    Errors are raised to the caller rather than yielded as text, so a failed
+    stream is never mistaken for (part of) the answer.
+    """
+    for chunk in _send(query, chat_history, stream=True):
+        yield chunk.text